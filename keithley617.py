@@ -69,6 +69,7 @@
 # enable_voltage_source():
 # open_connection():
 # read(interval = 0, samples = 1):
+# read_stream(interval = 0, samples = 1):
 # resistance_mode():
 # set_voltage_source(voltage):
 # voltage_mode():
@@ -76,7 +77,9 @@
 #################################################################
 # Import libraries
 #################################################################
+import re
 import time
+import warnings
 import prologixGPIBUSB as gpib
 from errors import Error
 
@@ -84,6 +87,21 @@ from errors import Error
 # Global Declarations
 #################################################################
 Debug = 0  # set to 1 to enable printing of error codes
+Address = 27  # GPIB address of the Keithley 617
+# Whether the serial port is open, so a stray close_connection is skipped.
+# The voltage source state is not cached because it can be changed from the
+# front panel, so its commands are always sent.
+State = {"connected": False}
+# A stored reading looks like NDCA+1.2345E-09,001 where the first four
+# characters are the prefix, followed by the value and the buffer location.
+DatumPattern = re.compile(br"^.{4}([^,]+),(\d{3})")
+# Command codes that start data storage at each allowed sample interval
+IntervalCommands = {0: "B1Q0G2X",     # store data as fast as possible
+                    1: "B1Q1G2X",     # store data every 1 s
+                    10: "B1Q2G2X",    # store data every 10 s
+                    60: "B1Q3G2X",    # store data every 60 s
+                    600: "B1Q4G2X",   # store data every 600 s
+                    3600: "B1Q5G2X"}  # store data every 3600 s
 
 #################################################################
 # Function definitions
@@ -91,13 +109,17 @@ Debug = 0  # set to 1 to enable printing of error codes
 
 # Close the connection to the Keithley 617.
 def close_connection():
+  if not State["connected"]:
+    return
   gpib.close_connection()
+  State["connected"] = False
 
 
 # Set the Keithley to measure current.
 def current_mode():
   gpib.write("F1X")
-  time.sleep(1)
+  gpib.readline()                   # discard the reading auto mode returns
+  wait_until_ready()
 
 
 # Disable the output of the Keithley's internal voltage source.
@@ -125,103 +147,70 @@ def enable_voltage_source():
 # and configure it to communicate with the Keithley 617.
 def open_connection():
   gpib.open_connection()
-  gpib.write("++addr 27")           # set GPIB address to the Keithley 617
-  gpib.clear_selected_device()      # Reset Keithley
-  gpib.write("C0X")                 # turn off zero check
-  gpib.write("C0X")                 # again, just to make sure :)
+  State["connected"] = True
+  write_batch(["++addr %d" % Address, # set GPIB address to the Keithley 617
+               "++auto 1",          # read back after every command
+               "++clr",             # Reset Keithley
+               "C0M16X"])           # zero check off, ready bit in status
   reading = gpib.readline()         # make sure Keithley's turned on 
-  if not "DC" in reading:
+  if not b"DC" in reading:
     raise Error("ERROR: The Keithley 617 is not responding, make "\
     "sure it is turned on.")
     
 
+# This function sends several command codes to the Prologix interface in a
+# single write.  The Prologix processes newline separated commands in
+# order, so this saves a USB round trip for every command after the first.
+def write_batch(commands):
+  gpib.write("\n".join(commands))
+
+
 # This function is the default value of the function parameter for the
 # Read function below.
-def do_nothing(dummy1, dummy2, dummy3):
+def do_nothing(dummy1, dummy2, *args):
   pass
 
 
 # This function is called by the read function in the event that 
 # samples > 1.
 def read_multiple(interval = 0, samples = 1, update_graph = do_nothing, *args):
-  if interval not in [0, 1, 10, 60, 600, 3600]:
-    raise Error("ERROR: The Keithley 617 allows interval values of " + \
-    "0, 1, 10, 60, 600, and 3600")
-  if samples > 100:
-    raise Error("ERROR: The Keithley 617 allows a maximum of 100 samples.")
-  #gpib.flushInput()            # discard any previous readings
-  if interval == 0:
-    gpib.write("B1Q0G2X")      # store data as fast as possible
-  elif interval == 1:
-    gpib.write("B1Q1G2X")      # store data every 1 s
-  elif interval == 10:
-    gpib.write("B1Q2G2X")      # store data every 10 s
-  elif interval == 60:
-    gpib.write("B1Q3G2X")      # store data every 60 s
-  elif interval == 600:
-    gpib.write("B1Q4G2X")      # store data every 600 s
-  elif interval == 3600:
-    gpib.write("B1Q5G2X")      # store data every 3600 s
-  else:
-    raise Error("ERROR: The Keithley 617 allows sample intervals of " + \
-    "0, 1, 10, 60, 600, or 3600 seconds.")
-  Time = []
-  Data = []
-  CurrentSample = 1
-  time.sleep(interval)
-  Datum = gpib.readline()
-  while CurrentSample <= samples:
-    if ",%03d" % CurrentSample in Datum:
-      Data = Data + [float(Datum[4:Datum.find(',')])]
-      if interval == 0:
-        # Keithley617 manual page 3-24
-        Time = Time + [(CurrentSample - 1) * 0.360]    
-      else:
-        Time = Time + [(CurrentSample - 1) * interval]
-      CurrentSample = CurrentSample + 1
+  Stream = read_stream(interval, samples)
+  Time = [0.0] * samples
+  Data = [0.0] * samples
+  try:
+    for n, (sample_time, value) in enumerate(Stream):
+      Time[n] = sample_time
+      Data[n] = value
       # call graph update function 
-      update_graph(Time[-1], Data[-1], *args)
-      time.sleep(interval)
-    elif ",%03d" % (CurrentSample -1) in Datum:
-      time.sleep(interval)
-    gpib.write("B1X")        # get a reading
-    Datum = gpib.readline()
-  gpib.write("Q7X")          # turn off data storage
+      update_graph(sample_time, value, *args)
+  finally:
+    Stream.close()             # turn off data storage even if update_graph fails
   return Time, Data
 
 
 # This function is called by the read function in the event that 
 # samples = 1.
 def read_one(interval = 0):
-  if interval == 0:
-    gpib.write("B1Q0G2X")      # store data as fast as possible
-  elif interval == 1:
-    gpib.write("B1Q1G2X")      # store data every 1 s
-  elif interval == 10:
-    gpib.write("B1Q2G2X")      # store data every 10 s
-  elif interval == 60:
-    gpib.write("B1Q3G2X")      # store data every 60 s
-  elif interval == 600:
-    gpib.write("B1Q4G2X")      # store data every 600 s
-  elif interval == 3600:
-    gpib.write("B1Q5G2X")      # store data every 3600 s
-  else:
-    raise Error("ERROR: The Keithley 617 allows sample intervals of " + \
-    "0, 1, 10, 60, 600, or 3600 seconds.")
+  gpib.write(store_command(interval))
   #gpib.flushInput()            # discard any previous readings
   samples = 2
   Data = []
+  # bind the names used in the polling loop to locals
+  write, readline, sleep = gpib.write, gpib.readline, time.sleep
+  match_datum = DatumPattern.match
   CurrentSample = 1
   Datum = gpib.readline()
   while CurrentSample <= samples:
-    if ",%03d" % CurrentSample in Datum:
-      Data = Data + [float(Datum[4:Datum.find(',')])]
+    Match = match_datum(Datum)
+    Location = Match and int(Match.group(2))
+    if Location == CurrentSample:
+      Data = Data + [float(Match.group(1))]
       CurrentSample = CurrentSample + 1
-      time.sleep(interval)
-    elif ",%03d" % (CurrentSample -1) in Datum:
-      time.sleep(interval)
-    gpib.write("B1X")        # get a reading
-    Datum = gpib.readline()
+      sleep(interval)
+    elif Location == CurrentSample - 1:
+      sleep(interval)
+    write("B1X")             # get a reading
+    Datum = readline()
   gpib.write("Q7X")          # turn off data storage
   return Data[-1]
 
@@ -240,29 +229,105 @@ def read_one(interval = 0):
 # The allowed values of the samples parameter are 1 to 100.
 def read(interval = 0, samples = 1, update_graph = do_nothing, *args):
   if samples > 1:
-    return read_multiple(interval, samples, update_graph, figure)
+    return read_multiple(interval, samples, update_graph, *args)
   else:
     return read_one(interval)
 
 
+# This function takes samples the same way as read_multiple but returns a
+# generator that yields each (time, value) pair as soon as the Keithley
+# stores it, so the caller can plot or stop the measurement part way through.
+# The parameters are checked when read_stream is called.  Data storage is
+# started by the first next() on the generator and turned off when it
+# finishes or is closed, so a generator that is never started sends nothing.
+def read_stream(interval = 0, samples = 1):
+  if samples > 100:
+    raise Error("ERROR: The Keithley 617 allows a maximum of 100 samples.")
+  #gpib.flushInput()            # discard any previous readings
+  command = store_command(interval)
+  if interval == 0:
+    period = 0.360                # Keithley617 manual page 3-24
+  else:
+    period = interval
+  Time = [n * period for n in range(samples)]
+
+  def stored_samples():
+    # bind the names used in the polling loop to locals
+    write, readline, sleep = gpib.write, gpib.readline, time.sleep
+    match_datum = DatumPattern.match
+    CurrentSample = 1
+    try:
+      write(command)
+      sleep(interval)
+      Datum = readline()
+      while CurrentSample <= samples:
+        Match = match_datum(Datum)
+        Location = Match and int(Match.group(2))
+        if Location == CurrentSample:
+          yield Time[CurrentSample - 1], float(Match.group(1))
+          CurrentSample = CurrentSample + 1
+          sleep(interval)
+        elif Location == CurrentSample - 1:
+          sleep(interval)
+        write("B1X")           # get a reading
+        Datum = readline()
+    finally:
+      write("Q7X")             # turn off data storage
+
+  return stored_samples()
+
+
 # Set the Keithley to measure resistance.
 def resistance_mode():
   gpib.write("F2X")
-  time.sleep(1)
+  gpib.readline()                   # discard the reading auto mode returns
+  wait_until_ready()
 
 
 # Set the value of the Keithley's internal voltage source.
 def set_voltage_source(voltage):
-  if abs((voltage / 0.05) - round(voltage / 0.05)) > 1e-10:
-    print 'Warning: The voltage source in the Keithley 617 has a ' \
-    'maximum resolution of 50 mV.'
-  gpib.write("V" + "%.2f" % voltage + "X")
+  quantized = round(voltage * 20) / 20.0   # nearest multiple of 50 mV
+  if abs(quantized - voltage) > 1e-10:
+    warnings.warn('The voltage source in the Keithley 617 has a ' \
+    'maximum resolution of 50 mV.', stacklevel = 2)
+  gpib.write("V%.2fX" % quantized)
+
+
+# This function returns the command code that starts data storage at the
+# requested sample interval.
+def store_command(interval):
+  try:
+    return IntervalCommands[interval]
+  except KeyError:
+    raise Error("ERROR: The Keithley 617 allows sample intervals of " + \
+    "0, 1, 10, 60, 600, or 3600 seconds.")
 
 
 # Set the Keithley to measure voltage.
 def voltage_mode():
   gpib.write("F0X")
-  time.sleep(1)
+  gpib.readline()                   # discard the reading auto mode returns
+  wait_until_ready()
+
+
+# Serial poll the Keithley until the ready bit of its status byte is set,
+# or until timeout seconds have passed.  This lets the mode functions above
+# return as soon as the Keithley has settled instead of always waiting for
+# one second.  open_connection sets the M16 status mask so that the ready
+# bit is reported.  Any reading returned for the previous command must
+# already have been read, so that each readline here gets one poll reply.
+# The deadline is checked between polls, so a reply that never arrives can
+# stretch it by up to the serial port timeout.
+def wait_until_ready(timeout = 1):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    gpib.write("++spoll")
+    reply = gpib.readline()
+    while reply and not reply.strip().isdigit():
+      reply = gpib.readline()         # skip readings left by earlier commands
+    if reply and int(reply) & 0x10:   # ready bit of the status byte
+      return
+    time.sleep(0.02)
 
 
 # This function writes command codes to the Keithley.  For debugging